@@ -0,0 +1,153 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import parcoursup_arrow
+import parcoursup_data
+import parcoursup_figures
+import parcoursup_sql
+from parcoursup_data import COUNTS, FORMATION, SPECIALTY, SUMMARY_FORMATION, YEAR
+
+
+def synthesize(df, factor=1, extra_years=0, seed=0):
+    # Scales the dataset: every detailed row is copied factor times under new
+    # formation names, then the last year is copied extra_years times with noisy counts
+    rng = np.random.default_rng(seed)
+    summary = df[df[FORMATION] == SUMMARY_FORMATION]
+    detailed = df[df[FORMATION] != SUMMARY_FORMATION]
+
+    copies = [detailed]
+    for k in range(1, factor):
+        copy = detailed.copy()
+        copy[FORMATION] = copy[FORMATION] + f" ({k})"
+        copies.append(copy)
+    df = pd.concat([summary] + copies, ignore_index=True)
+
+    last_year = df[YEAR].max()
+    df_last = df[df[YEAR] == last_year]
+    years = [df]
+    for k in range(1, extra_years + 1):
+        copy = df_last.copy()
+        copy[YEAR] = last_year + k
+        noise = rng.uniform(0.9, 1.1, size=(len(copy), 1))
+        counts = np.floor(copy[COUNTS].to_numpy() * noise).astype('int64')
+        # Keep wishes >= proposals >= acceptances
+        copy[COUNTS] = np.minimum.accumulate(counts, axis=1)
+        years.append(copy)
+    return pd.concat(years, ignore_index=True)
+
+
+def measure(func, repeat):
+    # Best wall time over repeat runs, then peak traced memory of one more run
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run(path, repeat):
+    results = []
+
+    def stage(name, func, times=repeat):
+        result, seconds, peak = measure(func, times)
+        results.append((name, seconds, peak))
+        return result
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def cold_load():
+            for name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, name))
+            return parcoursup_data.load_database(path, cache_dir)
+
+        stage('load_data (cold, csv)', cold_load)
+        df = stage('load_data (warm, feather)', lambda: parcoursup_data.load_database(path, cache_dir))
+
+    cube = stage('build_cube', lambda: parcoursup_data.build_cube(df))
+    stage('stream_cube (csv, chunked)', lambda: parcoursup_data.stream_cube([path]))
+    aggregates = stage('build_aggregates', lambda: parcoursup_data.build_aggregates(cube))
+    stage('build_rankings', lambda: parcoursup_data.build_rankings(aggregates))
+    # What adding a release costs once every other source's partitions are cached
+    partitions = list(aggregates['partitions'].values())
+    stage('merge_partitions (cached)', lambda: parcoursup_data.merge_partitions(partitions))
+    years = aggregates['years']
+    formation = aggregates['funnel'].index[0]
+    pair = aggregates['summary_by_year'][years[0]][SPECIALTY].iloc[0]
+
+    # Part 1 to Part 4 queries, on top of the precomputed aggregates
+    stage('part1 yearly totals', lambda: aggregates['yearly_totals'])
+    stage('part2 sunburst prep', lambda: [parcoursup_data.subject_combinations(aggregates, year) for year in years])
+    stage('part2 top 10 specialties', lambda: [parcoursup_data.top_specialties(aggregates, year) for year in years])
+    stage('part3 top duos', lambda: [parcoursup_data.top_duos(aggregates, year) for year in years])
+    stage('part3 top specialties per year', lambda: parcoursup_data.top_specialty_pairs(aggregates))
+    stage('part4 formation rankings', lambda: [parcoursup_data.top_formations(aggregates, n) for n in (10, 15)])
+    stage('part4 funnel (all years)', lambda: parcoursup_data.formation_funnel(aggregates).loc[formation])
+    stage('part4 funnel (year, pair)', lambda: parcoursup_data.formation_funnel(aggregates, years[0], pair))
+
+    for chart, params in parcoursup_figures.chart_variants(aggregates):
+        builder = parcoursup_figures.CHARTS[chart]
+        label = f"figure {chart}{'' if not params else ' ' + ' '.join(map(str, params))}"
+        budget = parcoursup_figures.BUDGETS.get(chart, {})
+        stage(label, lambda: builder(aggregates, *params, **budget))
+    stage('figure formation_funnel', lambda: parcoursup_figures.formation_funnel(aggregates, formation))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        def build_store():
+            for name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, name))
+            return parcoursup_sql.build_store([path], cache_dir)
+
+        store_path = stage('sqlite build_store', build_store, times=1)
+        stage('sqlite load_aggregates', lambda: parcoursup_sql.load_aggregates(store_path))
+        stage('sqlite funnel (year, pair)', lambda: parcoursup_sql.formation_funnel(store_path, years[0], pair))
+        parcoursup_sql.close(store_path)
+
+        arrow_path = parcoursup_arrow.store_path((path,), cache_dir)
+        stage('arrow write_store', lambda: parcoursup_arrow.write_store(aggregates, arrow_path), times=1)
+        stage('arrow load_aggregates (mmap)', lambda: parcoursup_arrow.load_aggregates(arrow_path))
+
+    store = parcoursup_figures.FigureStore(aggregates)
+    stage('figure store warm-up', lambda: parcoursup_figures.FigureStore(aggregates).warm_up(), times=1)
+    store.warm_up()
+    stage('figure store hit', lambda: store.get('subject_sunburst', years[0]))
+    return len(df), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time and memory of every stage of the Parcoursup page, outside a browser.")
+    parser.add_argument('--csv', default=parcoursup_data.DATABASE_PATH)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help="row multipliers applied to the detailed rows")
+    parser.add_argument('--extra-years', type=int, default=0, help="synthetic years added after the last one")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = pd.read_csv(args.csv, delimiter=';')
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'database.csv')
+            if scale == 1 and args.extra_years == 0:
+                path = args.csv
+            else:
+                synthesize(source, scale, args.extra_years).to_csv(path, sep=';', index=False)
+            rows, results = run(path, args.repeat)
+
+        print(f"\n{rows} rows (x{scale}, {args.extra_years} extra years)")
+        print(f"{'stage':<45} {'time (ms)':>12} {'peak (MiB)':>12}")
+        for name, seconds, peak in results:
+            print(f"{name:<45} {seconds * 1000:>12.2f} {peak / 2 ** 20:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
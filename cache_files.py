@@ -0,0 +1,39 @@
+import glob
+import hashlib
+import os
+import threading
+
+# Helpers shared by the on-disk caches: files are named after the content they
+# were built from, written atomically, and older builds are pruned
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def atomic_write(path, write):
+    # write(tmp_path) builds the file under a private name, which is then renamed,
+    # so concurrent readers never see a partial file. Nothing is left behind on failure
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def prune(pattern, keep):
+    # Removes the older builds matching pattern, other workers' temporary files are left alone
+    for stale_path in glob.glob(pattern):
+        if stale_path != keep and not stale_path.endswith('.tmp'):
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
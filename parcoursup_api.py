@@ -0,0 +1,224 @@
+import argparse
+import hashlib
+import json
+import signal
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import parcoursup_data
+import parcoursup_metrics
+from parcoursup_data import COUNTS, SPECIALTY
+from parcoursup_metrics import metrics
+
+# Headless JSON API over the same aggregates as the Streamlit page, for dashboards
+# and batch jobs. Responses are cached per dataset version and carry an ETag.
+
+
+class BadRequest(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+def records(df):
+    return json.loads(df.to_json(orient='records', force_ascii=False))
+
+
+def year_param(aggregates, params):
+    year = params.get('year')
+    if year is None:
+        return None
+    if not year.isdigit() or int(year) not in aggregates['years']:
+        raise BadRequest(f"year must be one of {aggregates['years']}")
+    return int(year)
+
+
+def int_param(params, name, default):
+    value = params.get(name, str(default))
+    if not value.isdigit() or int(value) < 1:
+        raise BadRequest(f"{name} must be a positive integer")
+    return int(value)
+
+
+def required_year(aggregates, params):
+    year = year_param(aggregates, params)
+    return aggregates['years'][-1] if year is None else year
+
+
+def yearly_totals(aggregates, params):
+    return records(aggregates['yearly_totals'])
+
+
+def specialty_pairs(aggregates, params):
+    # Distribution of the specialty pairs of a year, as in the sunburst
+    year = required_year(aggregates, params)
+    threshold = int_param(params, 'threshold', parcoursup_data.MIN_CANDIDATES_THRESHOLD)
+    return {'year': year, 'pairs': records(parcoursup_data.subject_combinations(aggregates, year, threshold))}
+
+
+def top_specialties(aggregates, params):
+    year = required_year(aggregates, params)
+    return {'year': year, 'top': records(parcoursup_data.top_specialties(aggregates, year, int_param(params, 'n', 10)))}
+
+
+def top_duos(aggregates, params):
+    year = required_year(aggregates, params)
+    return {'year': year, 'top': records(parcoursup_data.top_duos(aggregates, year, int_param(params, 'n', 10)))}
+
+
+def formation_rankings(aggregates, params):
+    # One ranking per count column, over all years or a single year
+    year = year_param(aggregates, params)
+    n = int_param(params, 'n', 10)
+    return {
+        'year': year,
+        'rankings': {
+            column: records(parcoursup_data.ranking(aggregates, 'formations', year, column, n).reset_index())
+            for column in COUNTS
+        },
+    }
+
+
+def known_pairs(aggregates):
+    return set().union(*(frame[SPECIALTY] for frame in aggregates['summary_by_year'].values()))
+
+
+def formation_funnel(aggregates, params):
+    formation = params.get('formation')
+    if formation is None:
+        raise BadRequest("formation is required")
+    year = year_param(aggregates, params)
+    specialty = params.get('specialty')
+    if specialty is not None and specialty not in known_pairs(aggregates):
+        raise NotFound(f"unknown specialty pair {specialty!r}, see /api/specialty-pairs")
+    funnel = parcoursup_data.formation_funnel(aggregates, year, specialty)
+    if formation not in funnel.index:
+        raise NotFound(f"no candidates for formation {formation!r}")
+    row = funnel.loc[[formation]].reset_index()
+    return {'year': year, 'specialty': specialty, 'funnel': records(row)[0]}
+
+
+ENDPOINTS = {
+    '/api/yearly-totals': yearly_totals,
+    '/api/specialty-pairs': specialty_pairs,
+    '/api/top-specialties': top_specialties,
+    '/api/top-duos': top_duos,
+    '/api/formation-rankings': formation_rankings,
+    '/api/funnel': formation_funnel,
+}
+
+
+class ResponseCache:
+    # Encoded responses keyed by (dataset version, path, query), least recently used evicted first
+
+    def __init__(self, paths=None, maxsize=1024):
+        self.paths = paths
+        self.maxsize = maxsize
+        self.version = None
+        self.aggregates = None
+        self.responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def current(self):
+        # The aggregates are reloaded when one of the CSV files changes or a release is added,
+        # paths default to PARCOURSUP_DATABASE expanded again on each request
+        paths = parcoursup_data.database_paths() if self.paths is None else self.paths
+        version = parcoursup_data.dataset_version(paths)
+        with self._lock:
+            if version != self.version:
+                parcoursup_metrics.mark_miss()
+                self.aggregates = parcoursup_data.load_aggregates(version)
+                self.version = version
+                self.responses.clear()
+            return version, self.aggregates
+
+    def get(self, path, params):
+        version, aggregates = self.current()
+        key = (version, path, tuple(sorted(params.items())))
+        with self._lock:
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                return self.responses[key]
+
+        parcoursup_metrics.mark_miss()
+        body = json.dumps(ENDPOINTS[path](aggregates, params), ensure_ascii=False).encode()
+        response = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+        with self._lock:
+            self.responses[key] = response
+            while len(self.responses) > self.maxsize:
+                self.responses.popitem(last=False)
+        return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in ENDPOINTS:
+            return self.send_json(404, {'error': f"unknown endpoint, try one of {sorted(ENDPOINTS)}"})
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        with metrics.timed('api', url.path, cache='hit'):
+            try:
+                body, etag = self.cache.get(url.path, params)
+            except BadRequest as error:
+                return self.send_json(400, {'error': str(error)})
+            except NotFound as error:
+                return self.send_json(404, {'error': str(error)})
+            except Exception:
+                # Always answer, the traceback goes to the server log only
+                self.log_error("unhandled error on %s", self.path)
+                traceback.print_exc()
+                return self.send_json(500, {'error': "internal server error"})
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        # Clients may keep responses but have to revalidate them, the data changes with each release
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Parcoursup aggregates as JSON.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    Handler.cache = ResponseCache()
+    Handler.cache.current()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    # SIGTERM would otherwise kill the process without running the atexit handlers,
+    # leaving this process's metrics file behind
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {sorted(ENDPOINTS)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
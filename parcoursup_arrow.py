@@ -0,0 +1,110 @@
+import glob
+import hashlib
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import parcoursup_data
+from parcoursup_data import COUNTS, FORMATION, SPECIALTY, YEAR
+
+# Optional backend: merged aggregates are written once per dataset version as
+# uncompressed Arrow IPC files, which every app process on the host memory-maps
+# read-only, so the numeric columns are shared through the page cache instead of copied
+
+
+def store_path(version, cache_dir=parcoursup_data.CACHE_DIR):
+    digest = hashlib.sha256(repr(version).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"arrow-{digest}-{parcoursup_data.CACHE_FORMAT}")
+
+
+def by_year(frames):
+    # Per-year tables are stored as a single table with a year column
+    return pd.concat([
+        (frame if isinstance(frame.index, pd.RangeIndex) else frame.reset_index()).assign(**{YEAR: year})
+        for year, frame in frames.items()
+    ], ignore_index=True)
+
+
+def write_store(aggregates, path):
+    detailed = pd.concat(
+        [partition['detailed'].reset_index() for partition in aggregates['partitions'].values()], ignore_index=True
+    )
+    tables = {
+        'yearly_totals': aggregates['yearly_totals'],
+        'summary': by_year(aggregates['summary_by_year']),
+        'specialty_totals': by_year(aggregates['specialty_totals_by_year']),
+        'wishes_pivot': aggregates['wishes_pivot'],
+        'formation_totals': aggregates['formation_totals'],
+        'funnel': aggregates['funnel'],
+        'funnel_by_year': by_year(aggregates['funnel_by_year']),
+        'detailed': detailed.astype({SPECIALTY: 'category', FORMATION: 'category'}),
+    }
+
+    # Written to a private directory then renamed, the first process to finish wins
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, df in tables.items():
+        table = pa.Table.from_pandas(df, preserve_index=not isinstance(df.index, pd.RangeIndex))
+        feather.write_feather(table, os.path.join(tmp_path, f"{name}.arrow"), compression='uncompressed')
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)
+    # Processes still on an older version keep their mappings, unlinking does not unmap
+    for stale_path in glob.glob(os.path.join(os.path.dirname(path), 'arrow-*')):
+        if stale_path != path and not stale_path.endswith('.tmp'):
+            shutil.rmtree(stale_path, ignore_errors=True)
+    return path
+
+
+def read_table(path, name):
+    return feather.read_table(os.path.join(path, f"{name}.arrow"), memory_map=True)
+
+
+def to_pandas(table):
+    # split_blocks keeps each numeric column a view on the mapped file
+    return table.to_pandas(split_blocks=True)
+
+
+def split_years(table):
+    # Years are contiguous in the stored table, each one is a zero-copy slice
+    frames = {}
+    years = table.column(YEAR).to_pandas()
+    for year, rows in years.groupby(years, sort=False).groups.items():
+        frame = to_pandas(table.slice(rows[0], len(rows)).drop_columns([YEAR]))
+        frames[int(year)] = frame
+    return frames
+
+
+def load_aggregates(path):
+    # Same tables as parcoursup_data.merge_partitions, mapped from the store
+    summary_by_year = split_years(read_table(path, 'summary'))
+    funnel_by_year = {
+        year: frame.set_index(FORMATION) for year, frame in split_years(read_table(path, 'funnel_by_year')).items()
+    }
+    aggregates = {
+        'arrow_store': path,
+        'years': list(summary_by_year),
+        'yearly_totals': to_pandas(read_table(path, 'yearly_totals')),
+        'summary_by_year': summary_by_year,
+        'specialty_totals_by_year': split_years(read_table(path, 'specialty_totals')),
+        'wishes_pivot': to_pandas(read_table(path, 'wishes_pivot')),
+        'formation_totals': to_pandas(read_table(path, 'formation_totals')),
+        'funnel': to_pandas(read_table(path, 'funnel')),
+        'funnel_by_year': funnel_by_year,
+        'detailed': to_pandas(read_table(path, 'detailed')),
+    }
+    aggregates['rankings'] = parcoursup_data.build_rankings(aggregates)
+    return aggregates
+
+
+def formation_funnel(aggregates, year=None, specialty=None):
+    # The partitions are not stored, specialty pairs are filtered from the flat cube
+    detailed = aggregates['detailed']
+    mask = detailed[SPECIALTY] == specialty
+    if year is not None:
+        mask &= detailed[YEAR] == year
+    return parcoursup_data.build_funnel(detailed[mask].groupby(FORMATION, observed=True)[COUNTS].sum())
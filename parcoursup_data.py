@@ -0,0 +1,430 @@
+import glob
+import hashlib
+import os
+
+import pandas as pd
+
+from cache_files import atomic_write, file_hash, prune
+
+DATABASE_PATH = "database.csv"
+# Several releases can be listed in PARCOURSUP_DATABASE, separated by os.pathsep,
+# each entry is a path or a glob pattern such as releases/*.csv
+DATABASE_SOURCES = os.environ.get('PARCOURSUP_DATABASE', DATABASE_PATH)
+CACHE_DIR = ".cache"
+# 'sqlite' or 'arrow' serve the aggregates from a store on disk shared by every
+# process, see parcoursup_sql and parcoursup_arrow
+BACKEND = os.environ.get('PARCOURSUP_BACKEND', 'pandas')
+# Bump whenever read_database changes what ends up in the cache file
+CACHE_FORMAT = 2
+# Bump whenever build_partition changes what ends up in the partition files
+PARTITION_FORMAT = 1
+# Rows per batch when streaming CSVs, and the file size above which a source is streamed
+CHUNKSIZE = 200_000
+STREAMING_THRESHOLD = 256 * 2 ** 20
+
+# Column names of the Parcoursup dataset
+YEAR = 'Année du Baccalauréat'
+SPECIALTY = 'Enseignements de spécialité'
+FORMATION = 'Formation'
+WISHES = 'Nombre de candidats bacheliers ayant confirmé au moins un vœu'
+PROPOSALS = 'Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission'
+ACCEPTED = 'Nombre de candidats bacheliers ayant accepté une proposition d\'admission'
+COUNTS = [WISHES, PROPOSALS, ACCEPTED]
+# The long text columns are parsed straight into categoricals
+CSV_DTYPES = {SPECIALTY: 'category', FORMATION: 'category'}
+
+# Columns derived from the specialty pair at load time
+SUBJECT1 = 'Subject1'
+SUBJECT2 = 'Subject2'
+SPECIALTIES = 'Specialties'
+
+# Columns of the per-formation funnel table
+NEVER_PROPOSED = 'Proposal never received'
+REFUSED = 'Refused Admissions'
+PROPOSALS_PERCENT = 'Pourcentage propositions reçues'
+ACCEPTED_PERCENT = 'Pourcentage propositions acceptées'
+
+# Specialty pairs and specialties chosen by fewer candidates are left out of the charts
+MIN_CANDIDATES_THRESHOLD = 1000
+# Depth of the precomputed rankings, the page shows top 10 and top 15 lists
+RANKING_DEPTH = 15
+
+# "Ensemble des bacheliers" rows hold counts of students for each duo of specialities
+SUMMARY_FORMATION = 'Ensemble des bacheliers'
+
+
+def database_paths(sources=DATABASE_SOURCES):
+    # Expanded on every call, so a release dropped next to the others is picked up
+    # on the next run. A pattern that matches nothing is kept and fails on stat
+    paths = []
+    for source in sources.split(os.pathsep):
+        paths.extend(sorted(glob.glob(source)) or [source])
+    return tuple(paths)
+
+
+def dataset_version(paths=DATABASE_PATH):
+    # Changes whenever one of the CSV files is replaced, used as a cache key
+    if isinstance(paths, str):
+        paths = [paths]
+    return tuple((path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths)
+
+
+def read_database(path=DATABASE_PATH):
+    # Use the correct delimiter for the CSV file
+    return normalize(pd.read_csv(path, delimiter=';', dtype=CSV_DTYPES))
+
+
+def read_chunks(paths, chunksize=CHUNKSIZE):
+    # Normalized batches of at most chunksize rows, one file after the other
+    for path in paths:
+        with pd.read_csv(path, delimiter=';', dtype=CSV_DTYPES, chunksize=chunksize) as reader:
+            for chunk in reader:
+                yield normalize(chunk)
+
+
+def normalize(df):
+    df[YEAR] = df[YEAR].astype('int16')
+    # Counts are whole numbers even when a column is parsed as float
+    for column in COUNTS:
+        df[column] = pd.to_numeric(df[column].astype('int64'), downcast='integer')
+    # Remove the word "Spécialité" at the end of the specialities name
+    df[SPECIALTY] = df[SPECIALTY].cat.rename_categories(lambda name: name.replace(' Spécialité', ''))
+    subjects = split_subjects(df[SPECIALTY].cat.categories)
+    df[SUBJECT1] = df[SPECIALTY].map(subjects[SUBJECT1]).astype('category')
+    df[SUBJECT2] = df[SPECIALTY].map(subjects[SUBJECT2]).astype('category')
+    return df
+
+
+def split_subjects(pairs):
+    # Subject1/Subject2 of each distinct specialty pair, vectorized over the pairs
+    parts = pd.Series(pairs, index=pairs).str.split(',')
+    return pd.DataFrame({
+        SUBJECT1: parts.str[0],
+        SUBJECT2: parts.str[1].fillna('Single'),
+    })
+
+
+def build_specialty_index(pairs):
+    # Each specialty mapped to the pairs it is part of
+    exploded = pd.Series(pairs, index=pairs).str.split(',').explode()
+    return pd.Series(exploded.index, index=pd.Index(exploded.values, name=SPECIALTIES), name=SPECIALTY)
+
+
+def cache_stem(path):
+    # Named after the source path too, so same-named releases in different folders keep their own cache
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}-{hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:8]}"
+
+
+def load_database(path=DATABASE_PATH, cache_dir=CACHE_DIR):
+    # Typed columnar copy of the CSV, rebuilt only when the CSV content changes
+    stem = cache_stem(path)
+    cache_path = os.path.join(cache_dir, f"{stem}-{file_hash(path)[:16]}-{CACHE_FORMAT}.feather")
+    if os.path.exists(cache_path):
+        return pd.read_feather(cache_path)
+
+    df = read_database(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(cache_path, df.to_feather)
+    prune(os.path.join(cache_dir, f"{stem}-*.feather"), cache_path)
+    return df
+
+
+def split_summary(df):
+    # Separate summary rows and detailed data
+    df_summary = df[df[FORMATION] == SUMMARY_FORMATION]
+    df_detailed = df[df[FORMATION] != SUMMARY_FORMATION]
+    return df_summary, df_detailed
+
+
+def build_cube(df):
+    # Sums of the count columns keyed by (year, specialty pair, formation),
+    # the subjects of each pair are carried along as extra index levels
+    keys = [YEAR, SPECIALTY, SUBJECT1, SUBJECT2, FORMATION]
+    return df.groupby(keys, observed=True)[COUNTS].sum().astype('int64')
+
+
+def stream_cube(paths, chunksize=CHUNKSIZE):
+    # Same cube as build_cube(read_database(path)), built batch by batch so memory
+    # is bounded by the number of distinct keys instead of the number of rows
+    keys = [YEAR, SPECIALTY, SUBJECT1, SUBJECT2, FORMATION]
+    cube = None
+    rows = 0
+    for chunk in read_chunks(paths, chunksize):
+        rows += len(chunk)
+        # Summary and detailed rows stay apart through the formation key
+        partial = chunk.groupby(keys, observed=True)[COUNTS].sum().astype('int64')
+        # Categories differ from one batch to the next, plain strings merge cleanly
+        partial.index = partial.index.set_levels(
+            [partial.index.levels[i].astype(str) for i in range(1, len(keys))], level=keys[1:]
+        )
+        cube = partial if cube is None else pd.concat([cube, partial]).groupby(level=keys, sort=False).sum()
+    cube = cube.sort_index()
+    cube.attrs['rows'] = rows
+    return cube
+
+
+def load_cube(paths=(DATABASE_PATH,), chunksize=CHUNKSIZE):
+    # A single small file goes through the Feather cache, anything else is streamed
+    if len(paths) == 1 and os.path.getsize(paths[0]) <= STREAMING_THRESHOLD:
+        df = load_database(paths[0])
+        cube = build_cube(df)
+        cube.attrs['rows'] = len(df)
+        return cube
+    return stream_cube(paths, chunksize)
+
+
+def split_partitions(cube):
+    # One partition per year, each with its own precomputed aggregates
+    return [build_partition(year, frame) for year, frame in cube.groupby(level=YEAR)]
+
+
+def build_partition(year, cube):
+    # Aggregates of a single year, computed from that year's rows of the cube only
+    is_summary = cube.index.get_level_values(FORMATION) == SUMMARY_FORMATION
+    summary = cube[is_summary].droplevel([YEAR, FORMATION])
+    detailed = cube[~is_summary]
+    formation_totals = detailed.groupby(level=FORMATION, observed=True).sum()
+
+    frame = summary.reset_index().astype({SPECIALTY: str, SUBJECT1: str, SUBJECT2: str})
+    specialty_index = build_specialty_index(frame[SPECIALTY].unique())
+    wishes = specialty_index.map(frame.set_index(SPECIALTY)[WISHES]).dropna().astype('int64')
+
+    partition = {
+        'year': year,
+        'cube': cube,
+        'detailed': detailed,
+        'totals': summary[COUNTS].sum(),
+        'summary': frame,
+        'specialty_totals': wishes.groupby(level=SPECIALTIES).sum().rename(WISHES).reset_index(),
+        'wishes': frame.set_index(SPECIALTY)[WISHES],
+        'formation_totals': formation_totals,
+        'funnel': build_funnel(formation_totals),
+    }
+    partition['rankings'] = rank_partition(partition)
+    return partition
+
+
+def merge_partitions(partitions):
+    # Cross-year tables built from the per-year aggregates, without going back to the rows
+    by_year = {}
+    for partition in partitions:
+        year = partition['year']
+        if year in by_year:
+            # Several sources for the same year: only that year is rebuilt
+            cube = pd.concat([by_year[year]['cube'], partition['cube']])
+            partition = build_partition(year, cube.groupby(level=cube.index.names, observed=True).sum())
+        by_year[year] = partition
+
+    years = sorted(year for year, partition in by_year.items() if len(partition['summary']))
+    formation_totals = pd.concat([partition['formation_totals'] for partition in by_year.values()])
+    formation_totals = formation_totals.groupby(level=FORMATION, observed=True).sum()
+
+    # The per-year rankings come with the partitions, only the all-years ones depend on the merge
+    rankings = {}
+    for year in years:
+        rankings.update(by_year[year]['rankings'])
+
+    aggregates = {
+        'partitions': by_year,
+        'years': years,
+        'yearly_totals': pd.DataFrame(
+            [by_year[year]['totals'] for year in years], index=pd.Index(years, name=YEAR)
+        ).reset_index(),
+        'summary_by_year': {year: by_year[year]['summary'] for year in years},
+        'specialty_totals_by_year': {year: by_year[year]['specialty_totals'] for year in years},
+        'wishes_pivot': pd.concat({year: by_year[year]['wishes'] for year in years}, names=[YEAR]).unstack(SPECIALTY),
+        'formation_totals': formation_totals,
+        'funnel': build_funnel(formation_totals),
+        'funnel_by_year': {year: partition['funnel'] for year, partition in by_year.items()},
+    }
+    aggregates['rankings'] = {
+        **rankings,
+        **{key: RANKINGS[key[0]](aggregates, *key[1:], RANKING_DEPTH) for key in overall_ranking_keys()},
+    }
+    return aggregates
+
+
+def build_aggregates(cube):
+    # Every chart of the Parcoursup page is a slice of these precomputed tables
+    return merge_partitions(split_partitions(cube))
+
+
+def source_partitions(path, file_version=None, cache_dir=CACHE_DIR):
+    # Per-year partitions of one source file, kept on disk under the file's content hash
+    # so a new release only aggregates its own years. file_version is only there as a cache key
+    stem = cache_stem(path)
+    cache_path = os.path.join(cache_dir, f"{stem}-{file_hash(path)[:16]}-{PARTITION_FORMAT}.partitions.pkl")
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+
+    partitions = split_partitions(load_cube([path]))
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(cache_path, lambda tmp_path: pd.to_pickle(partitions, tmp_path))
+    prune(os.path.join(cache_dir, f"{stem}-*.partitions.pkl"), cache_path)
+    return partitions
+
+
+def merge_sources(version, load_partitions=source_partitions):
+    partitions = [
+        partition
+        for path, *file_version in version
+        for partition in load_partitions(path, tuple(file_version))
+    ]
+    return merge_partitions(partitions)
+
+
+def load_aggregates(version, load_partitions=source_partitions):
+    # Aggregates of a dataset version from the configured BACKEND, shared by the page
+    # and the API. Callers can pass a load_partitions that caches each source file
+    if BACKEND == 'sqlite':
+        import parcoursup_sql
+        return parcoursup_sql.load_aggregates(parcoursup_sql.build_store([path for path, *_ in version]))
+    if BACKEND == 'arrow':
+        import parcoursup_arrow
+        # Only the first process on the host merges, the others map its store
+        path = parcoursup_arrow.store_path(version)
+        if not os.path.exists(path):
+            parcoursup_arrow.write_store(merge_sources(version, load_partitions), path)
+        return parcoursup_arrow.load_aggregates(path)
+    return merge_sources(version, load_partitions)
+
+
+def build_funnel(formation_totals):
+    # Counts, refusals and percentages of each formation, indexed by formation
+    funnel = formation_totals[COUNTS].copy()
+    funnel[NEVER_PROPOSED] = funnel[WISHES] - funnel[PROPOSALS]
+    funnel[REFUSED] = funnel[PROPOSALS] - funnel[ACCEPTED]
+    funnel[PROPOSALS_PERCENT] = funnel[PROPOSALS] * 100 / funnel[WISHES]
+    funnel[ACCEPTED_PERCENT] = funnel[ACCEPTED] * 100 / funnel[WISHES]
+    return funnel
+
+
+# Rankings sort stably so ties keep their order, and any top n is a prefix of a deeper one
+def rank_specialties(aggregates, year, metric, n):
+    return aggregates['specialty_totals_by_year'][year].sort_values(metric, ascending=False, kind='stable').head(n)
+
+
+def rank_pairs(aggregates, year, metric, n):
+    df_year = aggregates['summary_by_year'][year].set_index(SPECIALTY)
+    return df_year[metric].sort_values(ascending=False, kind='stable').head(n)
+
+
+def rank_duos(aggregates, year, metric, n):
+    df_year = aggregates['summary_by_year'][year]
+    df_duos = df_year.groupby([SUBJECT1, SUBJECT2])[metric].sum().reset_index()
+    return df_duos.sort_values(by=metric, ascending=False, kind='stable').head(n)
+
+
+def rank_formations(aggregates, year, metric, n):
+    formation_totals = aggregates['formation_totals'] if year is None else aggregates['funnel_by_year'][year]
+    return formation_totals[metric].sort_values(ascending=False, kind='stable').head(n)
+
+
+RANKINGS = {
+    'specialties': rank_specialties,
+    'pairs': rank_pairs,
+    'duos': rank_duos,
+    'formations': rank_formations,
+}
+
+
+def year_ranking_keys(year):
+    # Every (ranking, year, metric) of the ranking table for a single year
+    yield 'specialties', year, WISHES
+    for metric in COUNTS:
+        yield 'pairs', year, metric
+        yield 'duos', year, metric
+        yield 'formations', year, metric
+
+
+def overall_ranking_keys():
+    # Rankings over all years, a year of None
+    for metric in COUNTS:
+        yield 'formations', None, metric
+
+
+def ranking_keys(aggregates):
+    for year in aggregates['years']:
+        yield from year_ranking_keys(year)
+    yield from overall_ranking_keys()
+
+
+def build_rankings(aggregates):
+    # Built once per dataset version, each ranking keeps its top RANKING_DEPTH entries
+    return {key: RANKINGS[key[0]](aggregates, *key[1:], RANKING_DEPTH) for key in ranking_keys(aggregates)}
+
+
+def rank_partition(partition):
+    # Rankings of a partition's year, computed once with the partition and reused by every merge
+    year = partition['year']
+    tables = {
+        'specialty_totals_by_year': {year: partition['specialty_totals']},
+        'summary_by_year': {year: partition['summary']},
+        'funnel_by_year': {year: partition['funnel']},
+    }
+    return {key: RANKINGS[key[0]](tables, *key[1:], RANKING_DEPTH) for key in year_ranking_keys(year)}
+
+
+def ranking(aggregates, name, year, metric, n):
+    # Top n read from the ranking table, deeper rankings are computed on demand
+    rankings = aggregates.get('rankings')
+    if rankings is None or n > RANKING_DEPTH:
+        return RANKINGS[name](aggregates, year, metric, n)
+    return rankings[name, year, metric].head(n)
+
+
+def formation_funnel(aggregates, year=None, specialty=None):
+    # Precomputed for all years and for each year, specialty pairs are sliced from the cube
+    if year is not None and year not in aggregates['funnel_by_year']:
+        raise KeyError(f"no Parcoursup data for year {year}")
+    if specialty is None:
+        return aggregates['funnel'] if year is None else aggregates['funnel_by_year'][year]
+    if 'sql_store' in aggregates:
+        import parcoursup_sql
+        return parcoursup_sql.formation_funnel(aggregates['sql_store'], year, specialty)
+    if 'arrow_store' in aggregates:
+        import parcoursup_arrow
+        return parcoursup_arrow.formation_funnel(aggregates, year, specialty)
+
+    partitions = aggregates['partitions']
+    frames = [
+        partition['detailed'].xs(specialty, level=SPECIALTY)
+        for partition in (partitions.values() if year is None else [partitions[year]])
+        if specialty in partition['detailed'].index.get_level_values(SPECIALTY)
+    ]
+    if not frames:
+        # Unknown pair, or a pair absent that year: no formation has candidates
+        return build_funnel(pd.DataFrame(0, index=pd.Index([], name=FORMATION), columns=COUNTS))
+    return build_funnel(pd.concat(frames).groupby(level=FORMATION, observed=True).sum())
+
+
+def subject_combinations(aggregates, year, threshold=MIN_CANDIDATES_THRESHOLD):
+    df_year = aggregates['summary_by_year'][year]
+    return df_year[df_year[WISHES] >= threshold]
+
+
+def top_specialties(aggregates, year, n=10, threshold=MIN_CANDIDATES_THRESHOLD):
+    df_grouped = ranking(aggregates, 'specialties', year, WISHES, n)
+    return df_grouped[df_grouped[WISHES] >= threshold]
+
+
+def top_duos(aggregates, year, n=10):
+    return ranking(aggregates, 'duos', year, WISHES, n)
+
+
+def top_specialty_pairs(aggregates, n=10):
+    # Pairs in the top n by wishes of at least one year
+    top_pairs = set()
+    for year in aggregates['years']:
+        top_pairs.update(ranking(aggregates, 'pairs', year, WISHES, n).index)
+    return top_pairs
+
+
+def top_formations(aggregates, n=10):
+    # Formations in the top n of at least one count column
+    formation_totals = aggregates['formation_totals']
+    top = set()
+    for column in COUNTS:
+        top.update(ranking(aggregates, 'formations', None, column, n).index)
+    return formation_totals.index[formation_totals.index.isin(top)]
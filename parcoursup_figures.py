@@ -0,0 +1,286 @@
+import inspect
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from parcoursup_data import (
+    ACCEPTED, COUNTS, FORMATION, NEVER_PROPOSED, PROPOSALS, REFUSED, SPECIALTIES, SPECIALTY, SUBJECT1, SUBJECT2, WISHES,
+    YEAR
+)
+import parcoursup_data
+import parcoursup_metrics
+
+# Upper bound on the number of lines of the multi-line charts
+MAX_SERIES = 30
+# Label of the bucket the smallest categories are grouped into
+OTHER = 'Other'
+
+# Payload budget of each chart and table sent to the browser, None means no limit.
+# max_categories groups the smallest categories into OTHER, max_series drops the
+# smallest lines, max_frames keeps the first animation frames, page_size paginates a table
+DEFAULT_BUDGETS = {
+    'subject_sunburst': {'max_categories': 40},
+    'specialty_trends': {'max_series': MAX_SERIES},
+    'formation_stages': {'max_categories': 15, 'max_frames': 3},
+    'formation_categories': {'max_series': MAX_SERIES},
+    'formation_table': {'page_size': 25},
+    'funnel_table': {'page_size': 25},
+}
+# Per chart overrides as JSON, e.g. PARCOURSUP_BUDGETS='{"subject_sunburst": {"max_categories": 20}}'
+BUDGET_OVERRIDES = json.loads(os.environ.get('PARCOURSUP_BUDGETS', '{}'))
+# Budget keys a chart accepts are those of CHART_BUDGET_KEYS its builder takes
+CHART_BUDGET_KEYS = {'max_categories', 'max_series', 'max_frames'}
+# Smallest accepted values, the others must be at least 1. One category would be
+# only the OTHER bucket
+MIN_BUDGETS = {'max_categories': 2}
+TABLE_BUDGETS = {'formation_table': {'page_size'}, 'funnel_table': {'page_size'}}
+
+FUNNEL_COLORS = {
+    'Wishes': '#2ca02c',
+    'Proposals Received': '#2ca02c',
+    'Student Admitted': '#2ca02c',
+    'Proposal never received': '#8B0000',
+    'Refused Admissions': '#8B0000'
+}
+
+
+def cap_series(df_pivot, max_series):
+    # Keep the max_series columns with the largest totals, in their original order
+    if max_series is None or df_pivot.shape[1] <= max_series:
+        return df_pivot
+    keep = df_pivot.sum().nlargest(max_series).index
+    return df_pivot.loc[:, df_pivot.columns.isin(keep)]
+
+
+def group_other(df, labels, values, max_categories):
+    # Keep the max_categories - 1 rows with the largest first value, the others are
+    # summed into a single OTHER row, so totals are unchanged and at most
+    # max_categories rows are left
+    if max_categories is None or len(df) <= max_categories:
+        return df
+    keep = df[values[0]].sort_values(ascending=False, kind='stable').index[:max_categories - 1]
+    other = df.drop(keep)[values].sum().to_frame().T.assign(**dict.fromkeys(labels, OTHER))
+    return pd.concat([df.loc[df.index.isin(keep)], other], ignore_index=True)
+
+
+def line_traces(df_pivot, mode):
+    # One trace per column, built from the pivot's arrays as plain dicts so
+    # plotly validates them once, when the figure is created
+    x = df_pivot.index.to_numpy()
+    values = df_pivot.to_numpy()
+    return [
+        dict(type='scatter', x=x, y=values[:, i], mode=mode, name=column, line=dict(width=2))
+        for i, column in enumerate(df_pivot.columns)
+    ]
+
+
+def yearly_trends(aggregates):
+    fig_line = px.line(aggregates['yearly_totals'], x=YEAR,
+                       y=COUNTS,
+                       title="Trends in Candidates, Offers, and Acceptances",
+                       labels={'value': 'Number of Candidates', 'variable': 'Category'})
+    return fig_line
+
+
+def subject_sunburst(aggregates, year, max_categories=None):
+    df_filtered = parcoursup_data.subject_combinations(aggregates, year)
+    df_filtered = group_other(df_filtered[[SUBJECT1, SUBJECT2, WISHES]], [SUBJECT1, SUBJECT2], [WISHES], max_categories)
+
+    fig_sunburst = px.sunburst(df_filtered, path=[SUBJECT1, SUBJECT2],
+                               values=WISHES,
+                               title=f"Subject Combinations in {year}")
+    fig_sunburst.update_layout(height=1000)
+    return fig_sunburst
+
+
+def top_specialties(aggregates, year):
+    top_10_specialties = parcoursup_data.top_specialties(aggregates, year)
+    fig_bar_chart = px.bar(top_10_specialties,
+                           x=SPECIALTIES,
+                           y=WISHES,
+                           labels={SPECIALTIES: 'Specialty', WISHES: 'Number of Wishes'},
+                           title=f"Top 10 Most Chosen Specialties in {year}")
+    fig_bar_chart.update_layout(height=600, width=1000, title_x=0.5)
+    return fig_bar_chart
+
+
+def specialty_trends(aggregates, n=10, max_series=MAX_SERIES):
+    wishes_pivot = aggregates['wishes_pivot']
+    top_pairs = parcoursup_data.top_specialty_pairs(aggregates, n)
+    df_pivot = cap_series(wishes_pivot.loc[:, wishes_pivot.columns.isin(top_pairs)], max_series)
+
+    fig = go.Figure(data=line_traces(df_pivot, 'lines'))
+
+    fig.update_layout(
+        title="Nombre de candidats bacheliers ayant confirmé au moins un vœu pour les spécialités les plus représentées",
+        xaxis_title=YEAR,
+        yaxis_title="Nombre de candidats",
+        template="plotly_dark",
+        legend_title=SPECIALTY
+    )
+    return fig
+
+
+def formation_stages(aggregates, max_categories=None, max_frames=None):
+    formation_totals = aggregates['formation_totals']
+    top_formations = parcoursup_data.top_formations(aggregates, 10)
+
+    df_evolution = pd.DataFrame({
+        FORMATION: top_formations,
+        'Confirmed Wishes': formation_totals[WISHES].reindex(top_formations).values,
+        'Admission Proposals': formation_totals[PROPOSALS].reindex(top_formations).values,
+        'Accepted Admissions': formation_totals[ACCEPTED].reindex(top_formations).values
+    })
+    stages = ['Confirmed Wishes', 'Admission Proposals', 'Accepted Admissions'][:max_frames]
+    # Every bar is a trace in every frame, the smallest formations share one bar
+    df_evolution = group_other(df_evolution, [FORMATION], stages, max_categories)
+    df_melted = df_evolution.melt(id_vars=FORMATION, value_vars=stages,
+                                  var_name='Stage', value_name='Count')
+
+    fig_bar_animation = px.bar(df_melted,
+                               x=FORMATION,
+                               y='Count',
+                               color=FORMATION,
+                               animation_frame='Stage',
+                               title="Top 15 Formations by Confirmed Wishes, Admission Proposals, and Accepted Admissions",
+                               labels={'Count': 'Number of Students', FORMATION: 'Formation'},
+                               range_y=[0, df_melted['Count'].max()])
+    fig_bar_animation.update_layout(transition_duration=1000)
+    return fig_bar_animation
+
+
+def formation_categories(aggregates, n=15, max_series=MAX_SERIES):
+    formation_totals = aggregates['formation_totals']
+    # One column per formation, indexed by category
+    plot_data = formation_totals.loc[parcoursup_data.top_formations(aggregates, n), COUNTS].T
+    plot_data = cap_series(plot_data, max_series)
+
+    fig = go.Figure(data=line_traces(plot_data, 'lines+markers'))
+
+    fig.update_layout(
+        title="Nombre de candidats bacheliers par catégorie",
+        xaxis_title="Catégories",
+        yaxis_title="Nombre de candidats",
+        template="plotly_dark",
+        legend_title="Formations",
+        height=1000
+    )
+    return fig
+
+
+def formation_funnel(aggregates, formation, year=None, specialty=None):
+    funnel = parcoursup_data.formation_funnel(aggregates, year, specialty)
+    wishes, proposals, accepted, refused_prop, refused_adm = [
+        funnel.at[formation, column] for column in COUNTS + [NEVER_PROPOSED, REFUSED]
+    ]
+
+    fig = go.Figure(go.Sunburst(
+        labels=['Wishes', 'Proposals Received', 'Student Admitted', 'Proposal never received', 'Refused Admissions'],
+        parents=['', 'Wishes', 'Proposals Received', 'Wishes', 'Proposals Received'],
+        values=[wishes, proposals, accepted, refused_prop, refused_adm, refused_prop],
+        textinfo='label+value',
+        branchvalues='total',
+        marker=dict(colors=[
+            FUNNEL_COLORS['Wishes'],
+            FUNNEL_COLORS['Proposals Received'],
+            FUNNEL_COLORS['Student Admitted'],
+            FUNNEL_COLORS['Proposal never received'],
+            FUNNEL_COLORS['Refused Admissions']
+        ])
+    ))
+
+    fig.update_layout(
+        title_text="Pourcentage of proposition received and accepted over the number of wishes made.",
+        height=600,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)"
+    )
+    return fig
+
+
+# Chart id -> builder, the builder's extra arguments are part of the cache key
+CHARTS = {
+    'yearly_trends': yearly_trends,
+    'subject_sunburst': subject_sunburst,
+    'top_specialties': top_specialties,
+    'specialty_trends': specialty_trends,
+    'formation_stages': formation_stages,
+    'formation_categories': formation_categories,
+    'formation_funnel': formation_funnel,
+}
+
+
+def load_budgets(overrides):
+    # Overrides are checked here, a wrong key would otherwise only fail when the chart is built
+    budgets = {chart: dict(budget) for chart, budget in DEFAULT_BUDGETS.items()}
+    for chart, budget in overrides.items():
+        if not isinstance(budget, dict):
+            raise ValueError(f"PARCOURSUP_BUDGETS: {chart} must map budget names to values, got {budget!r}")
+        if chart in CHARTS:
+            allowed = CHART_BUDGET_KEYS & set(inspect.signature(CHARTS[chart]).parameters)
+        elif chart in TABLE_BUDGETS:
+            allowed = TABLE_BUDGETS[chart]
+        else:
+            raise ValueError(f"PARCOURSUP_BUDGETS: unknown chart {chart!r}, expected one of {sorted({**CHARTS, **TABLE_BUDGETS})}")
+        unknown = set(budget) - allowed
+        if unknown:
+            raise ValueError(f"PARCOURSUP_BUDGETS: {chart} does not take {sorted(unknown)}, expected {sorted(allowed)}")
+        for key, value in budget.items():
+            # bool is an int too, true would otherwise pass as a budget of 1
+            minimum = MIN_BUDGETS.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+                raise ValueError(f"PARCOURSUP_BUDGETS: {chart}.{key} must be an integer >= {minimum}, got {value!r}")
+        budgets[chart] = {**budgets.get(chart, {}), **budget}
+    return budgets
+
+
+BUDGETS = load_budgets(BUDGET_OVERRIDES)
+
+
+def chart_variants(aggregates):
+    # Every chart without parameters plus every year variant
+    for chart in ['yearly_trends', 'specialty_trends', 'formation_stages', 'formation_categories']:
+        yield chart, ()
+    for chart in ['subject_sunburst', 'top_specialties']:
+        for year in aggregates['years']:
+            yield chart, (year,)
+
+
+class FigureStore:
+    # Serialized figures keyed by (chart id, parameters) with LRU eviction
+
+    def __init__(self, aggregates, maxsize=128, budgets=BUDGETS):
+        self.aggregates = aggregates
+        self.maxsize = maxsize
+        self.budgets = budgets
+        self._specs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chart, *params):
+        key = (chart, params)
+        with self._lock:
+            spec = self._specs.get(key)
+            if spec is not None:
+                self._specs.move_to_end(key)
+
+        if spec is None:
+            parcoursup_metrics.mark_miss()
+            spec = CHARTS[chart](self.aggregates, *params, **self.budgets.get(chart, {})).to_json()
+            with self._lock:
+                self._specs[key] = spec
+                self._specs.move_to_end(key)
+                while len(self._specs) > self.maxsize:
+                    self._specs.popitem(last=False)
+
+        # The spec comes from a figure plotly already validated
+        return go.Figure(json.loads(spec), _validate=False)
+
+    def warm_up(self):
+        for chart, params in chart_variants(self.aggregates):
+            self.get(chart, *params)
+        return self
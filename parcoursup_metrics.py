@@ -0,0 +1,140 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from cache_files import atomic_write
+
+# One Prometheus text file per process, e.g. for node_exporter's textfile collector
+METRICS_DIR = os.environ.get('PARCOURSUP_METRICS_DIR', os.path.join('.cache', 'metrics'))
+# Set to a file path to also get every event as a JSON line
+METRICS_LOG = os.environ.get('PARCOURSUP_METRICS_LOG')
+FLUSH_INTERVAL = 1.0
+
+logger = logging.getLogger('parcoursup.metrics')
+
+_local = threading.local()
+
+
+class Metrics:
+    # Process-wide totals per (section, step) and the latest events for the debug panel
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, history=200):
+        self.path = path
+        # Replicas write one file each, the pid label keeps their series distinct
+        self.pid = os.getpid()
+        self.flush_interval = flush_interval
+        self.totals = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'rows': 0, 'hits': 0, 'misses': 0})
+        self.events = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    @contextmanager
+    def timed(self, section, step, cache=None):
+        # cache is 'hit' when the step reads from a cache, the cached code calls mark_miss()
+        event = {'time': time.time(), 'section': section, 'step': step, 'rows': None, 'cache': cache}
+        parent = getattr(_local, 'event', None)
+        _local.event = event
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            event['seconds'] = time.perf_counter() - start
+            _local.event = parent
+            self.record(event)
+
+    def record(self, event):
+        with self._lock:
+            totals = self.totals[event['section'], event['step']]
+            totals['calls'] += 1
+            totals['seconds'] += event['seconds']
+            totals['rows'] += event['rows'] or 0
+            if event['cache'] == 'hit':
+                totals['hits'] += 1
+            elif event['cache'] == 'miss':
+                totals['misses'] += 1
+            self.events.append(event)
+
+        logger.info(json.dumps(event, ensure_ascii=False))
+        self.flush_if_due()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: dict(totals) for key, totals in self.totals.items()}, list(self.events)
+
+    def prometheus(self):
+        totals, _ = self.snapshot()
+        metrics = [
+            ('parcoursup_step_calls_total', 'counter', 'Executions of a step', 'calls'),
+            ('parcoursup_step_seconds_total', 'counter', 'Wall time spent in a step', 'seconds'),
+            ('parcoursup_step_rows_total', 'counter', 'Rows processed by a step', 'rows'),
+            ('parcoursup_cache_hits_total', 'counter', 'Cache hits of a step', 'hits'),
+            ('parcoursup_cache_misses_total', 'counter', 'Cache misses of a step', 'misses'),
+        ]
+        lines = []
+        for name, kind, description, field in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (section, step), values in sorted(totals.items()):
+                lines.append(f'{name}{{pid="{self.pid}",section="{section}",step="{step}"}} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def flush_if_due(self):
+        # At most one write per flush_interval, however many events come in
+        with self._lock:
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        text = self.prometheus()
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as file:
+                file.write(text)
+
+        atomic_write(self.path, write)
+
+    def remove(self):
+        # A stopped process must not leave frozen counters for the textfile collector
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def mark_miss():
+    # Called from inside cached code, which only runs on a miss
+    event = getattr(_local, 'event', None)
+    if event is not None and event['cache'] is not None:
+        event['cache'] = 'miss'
+
+
+def set_rows(rows):
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        event['rows'] = rows
+
+
+def add_rows(rows):
+    event = getattr(_local, 'event', None)
+    if event is not None:
+        event['rows'] = (event['rows'] or 0) + rows
+
+
+if METRICS_LOG:
+    handler = logging.FileHandler(METRICS_LOG)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+metrics = Metrics(os.path.join(METRICS_DIR, f"parcoursup-{os.getpid()}.prom"))
+# Only runs on a normal exit: Streamlit stops cleanly on SIGTERM and parcoursup_api
+# turns SIGTERM into one, a killed process still leaves its file behind
+atexit.register(metrics.remove)
@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+import parcoursup_data
+from cache_files import atomic_write, file_hash, prune
+from parcoursup_data import (
+    ACCEPTED, COUNTS, FORMATION, PROPOSALS, SPECIALTIES, SPECIALTY, SUBJECT1, SUBJECT2, SUMMARY_FORMATION, WISHES, YEAR
+)
+
+# Optional backend: the dataset lives in one SQLite file on disk that every app
+# worker opens read-only, instead of each worker holding its own pandas copies
+SCHEMA = """
+CREATE TABLE parcoursup (
+    year INTEGER NOT NULL,
+    specialty TEXT NOT NULL,
+    subject1 TEXT NOT NULL,
+    subject2 TEXT NOT NULL,
+    formation TEXT NOT NULL,
+    wishes INTEGER NOT NULL,
+    proposals INTEGER NOT NULL,
+    accepted INTEGER NOT NULL
+);
+CREATE TABLE pair_specialties (
+    specialty TEXT NOT NULL,
+    pair TEXT NOT NULL
+);
+"""
+
+INDEXES = """
+CREATE INDEX parcoursup_year ON parcoursup (year);
+CREATE INDEX parcoursup_formation ON parcoursup (formation, year, specialty);
+CREATE INDEX parcoursup_specialty ON parcoursup (specialty, year);
+CREATE INDEX pair_specialties_pair ON pair_specialties (pair);
+"""
+
+COUNT_COLUMNS = f'SUM(wishes) AS "{WISHES}", SUM(proposals) AS "{PROPOSALS}", SUM(accepted) AS "{ACCEPTED}"'
+
+_local = threading.local()
+
+
+def store_path(paths, cache_dir=parcoursup_data.CACHE_DIR):
+    # One store per set of source files, named after their content
+    digest = '-'.join(file_hash(path)[:16] for path in paths)
+    return os.path.join(cache_dir, f"parcoursup-{digest}-{parcoursup_data.CACHE_FORMAT}.sqlite")
+
+
+def write_store(paths, tmp_path):
+    con = sqlite3.connect(tmp_path)
+    try:
+        con.executescript(SCHEMA)
+        pairs = set()
+        for chunk in parcoursup_data.read_chunks(paths):
+            pairs.update(chunk[SPECIALTY].cat.categories)
+            rows = chunk[[YEAR, SPECIALTY, SUBJECT1, SUBJECT2, FORMATION] + COUNTS].astype(
+                {SPECIALTY: str, SUBJECT1: str, SUBJECT2: str, FORMATION: str}
+            )
+            con.executemany("INSERT INTO parcoursup VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            rows.itertuples(index=False, name=None))
+        specialty_index = parcoursup_data.build_specialty_index(sorted(pairs))
+        con.executemany("INSERT INTO pair_specialties VALUES (?, ?)", specialty_index.items())
+        con.executescript(INDEXES)
+        con.commit()
+    finally:
+        con.close()
+
+
+def build_store(paths, cache_dir=parcoursup_data.CACHE_DIR):
+    path = store_path(paths, cache_dir)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(path, lambda tmp_path: write_store(paths, tmp_path))
+    # Workers still on an older store keep their open connections, unlinking does not close them
+    prune(os.path.join(cache_dir, 'parcoursup-*.sqlite'), path)
+    return path
+
+
+def connect(path):
+    # One read-only connection per thread and store
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        connections[path] = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+    return connections[path]
+
+
+def close(path):
+    connection = getattr(_local, 'connections', {}).pop(path, None)
+    if connection is not None:
+        connection.close()
+
+
+def query(path, sql, params=()):
+    return pd.read_sql_query(sql, connect(path), params=params)
+
+
+def years(path):
+    sql = "SELECT DISTINCT year FROM parcoursup WHERE formation = ? ORDER BY year"
+    return query(path, sql, (SUMMARY_FORMATION,))['year'].tolist()
+
+
+def yearly_totals(path):
+    sql = f"""
+        SELECT year AS "{YEAR}", {COUNT_COLUMNS} FROM parcoursup
+        WHERE formation = ? GROUP BY year ORDER BY year
+    """
+    return query(path, sql, (SUMMARY_FORMATION,))
+
+
+def summary(path, year):
+    sql = f"""
+        SELECT specialty AS "{SPECIALTY}", subject1 AS "{SUBJECT1}", subject2 AS "{SUBJECT2}", {COUNT_COLUMNS}
+        FROM parcoursup WHERE formation = ? AND year = ?
+        GROUP BY specialty, subject1, subject2 ORDER BY specialty
+    """
+    return query(path, sql, (SUMMARY_FORMATION, year))
+
+
+def specialty_totals(path, year):
+    sql = f"""
+        SELECT s.specialty AS "{SPECIALTIES}", SUM(p.wishes) AS "{WISHES}"
+        FROM parcoursup p JOIN pair_specialties s ON s.pair = p.specialty
+        WHERE p.formation = ? AND p.year = ?
+        GROUP BY s.specialty ORDER BY s.specialty
+    """
+    return query(path, sql, (SUMMARY_FORMATION, year))
+
+
+def wishes_pivot(path):
+    sql = f"""
+        SELECT year AS "{YEAR}", specialty AS "{SPECIALTY}", SUM(wishes) AS wishes
+        FROM parcoursup WHERE formation = ? GROUP BY year, specialty
+    """
+    return query(path, sql, (SUMMARY_FORMATION,)).set_index([YEAR, SPECIALTY])['wishes'].unstack(SPECIALTY).astype('float64')
+
+
+def formation_totals(path, year=None, specialty=None):
+    conditions, params = ["formation != ?"], [SUMMARY_FORMATION]
+    if year is not None:
+        conditions.append("year = ?")
+        params.append(year)
+    if specialty is not None:
+        conditions.append("specialty = ?")
+        params.append(specialty)
+    sql = f"""
+        SELECT formation AS "{FORMATION}", {COUNT_COLUMNS} FROM parcoursup
+        WHERE {' AND '.join(conditions)} GROUP BY formation ORDER BY formation
+    """
+    # Typed explicitly, an empty result would otherwise come back as object columns
+    return query(path, sql, params).set_index(FORMATION).astype('int64')
+
+
+def formation_funnel(path, year=None, specialty=None):
+    return parcoursup_data.build_funnel(formation_totals(path, year, specialty))
+
+
+def load_aggregates(path):
+    # Same tables as parcoursup_data.build_aggregates, queried from the store. The
+    # rankings are built from these tables like on the pandas path, so ties break the same way
+    store_years = years(path)
+    totals = formation_totals(path)
+    aggregates = {
+        'sql_store': path,
+        'years': store_years,
+        'yearly_totals': yearly_totals(path),
+        'summary_by_year': {year: summary(path, year) for year in store_years},
+        'specialty_totals_by_year': {year: specialty_totals(path, year) for year in store_years},
+        'wishes_pivot': wishes_pivot(path),
+        'formation_totals': totals,
+        'funnel': parcoursup_data.build_funnel(totals),
+        'funnel_by_year': {year: formation_funnel(path, year) for year in store_years},
+    }
+    aggregates['rankings'] = parcoursup_data.build_rankings(aggregates)
+    return aggregates
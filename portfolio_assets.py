@@ -0,0 +1,51 @@
+import os
+
+from PIL import Image, ImageOps
+
+from cache_files import atomic_write, file_hash
+
+# Resized copies of the app's images, named after the content of the source image
+ASSETS_DIR = os.path.join('.cache', 'assets')
+# Variants written for each display width, 2x is for high density screens
+VARIANT_SCALES = (1, 2)
+JPEG_QUALITY = 80
+
+
+def file_version(path):
+    # Cheap cache key for the in-memory cache, the disk cache uses the content hash
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def variant_path(path, digest, width, assets_dir=ASSETS_DIR):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(assets_dir, f"{stem}-{digest[:16]}-{width}w.jpg")
+
+
+def build_variant(image, width, path, quality=JPEG_QUALITY):
+    height = round(image.height * width / image.width)
+    resized = image.resize((width, height), Image.LANCZOS)
+    atomic_write(path, lambda tmp_path: resized.save(
+        tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True
+    ))
+
+
+def build_variants(path, width, assets_dir=ASSETS_DIR):
+    # Downscaled, re-encoded JPEGs of the image for each scale of the display width,
+    # the source is only decoded when one of them is missing
+    digest = file_hash(path)
+    variants = {scale: variant_path(path, digest, width * scale, assets_dir) for scale in VARIANT_SCALES}
+    missing = {scale: variant for scale, variant in variants.items() if not os.path.exists(variant)}
+    if missing:
+        os.makedirs(assets_dir, exist_ok=True)
+        with Image.open(path) as source:
+            # Phone photos store their rotation in EXIF, apply it before dropping the metadata
+            image = ImageOps.exif_transpose(source).convert('RGB')
+        for scale, variant in missing.items():
+            build_variant(image, min(width * scale, image.width), variant)
+    return variants
+
+
+def thumbnail(path, width, scale=1, assets_dir=ASSETS_DIR):
+    with open(build_variants(path, width, assets_dir)[scale], 'rb') as file:
+        return file.read()
@@ -1,26 +1,93 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+
+import parcoursup_data
+import parcoursup_figures
+import parcoursup_metrics
+import portfolio_assets
+from parcoursup_data import ACCEPTED_PERCENT, COUNTS, PROPOSALS_PERCENT, WISHES
+from parcoursup_metrics import metrics
 
 # Set page config (must be the first Streamlit command)
 st.set_page_config(page_title="Parcoursup Data Analysis", layout="wide")
 
 # Load data
-@st.cache_data
-def load_data():
-    # Use the correct delimiter for the CSV file
-    df = pd.read_csv("database.csv", delimiter=';')
-    # Separate summary rows and detailed data
-    df_summary = df[df['Formation'] == 'Ensemble des bacheliers']
-    df_detailed = df[df['Formation'] != 'Ensemble des bacheliers']
-    
-    return df_summary, df_detailed
-
-
-df_summary, df_detailed= load_data()
+# Bounded so a replaced CSV does not keep its old entries alive for the life of the process,
+# releases evicted from memory are read back from their partition files on disk
+@st.cache_resource(max_entries=32)
+def load_partitions(path, file_version):
+    # Cached per source file, so adding a release only aggregates that file's years
+    partitions = parcoursup_data.source_partitions(path, file_version)
+    parcoursup_metrics.add_rows(sum(len(partition['cube']) for partition in partitions))
+    return partitions
+
+
+@st.cache_resource(max_entries=1)
+def load_data(version):
+    # Merged once per dataset version and shared by every session
+    parcoursup_metrics.mark_miss()
+    return parcoursup_data.load_aggregates(version, load_partitions)
+
+
+@st.cache_resource(max_entries=1)
+def load_figures(version):
+    # Pre-renders every year variant the first time the project page is opened
+    parcoursup_metrics.mark_miss()
+    return parcoursup_figures.FigureStore(load_data(version)).warm_up()
+
+
+# A few entries per image shown on the page, a replaced image drops out instead of piling up
+@st.cache_resource(max_entries=8)
+def load_image(path, width, file_version):
+    # Thumbnail bytes kept in memory per image version, built once on disk for all workers
+    return portfolio_assets.thumbnail(path, width)
+
+
+def show_image(path, width):
+    # Already at the display width, so Streamlit sends the bytes without re-encoding them
+    st.image(load_image(path, width, portfolio_assets.file_version(path)), width=width)
+
+
+@st.fragment
+def show_table(section, table, df):
+    # Long tables are sent one page at a time, paging only reruns the table
+    page_size = parcoursup_figures.BUDGETS.get(table, {}).get('page_size')
+    if page_size and len(df) > page_size:
+        pages = -(-len(df) // page_size)
+        page = st.number_input(f"Page (1 to {pages})", min_value=1, max_value=pages, key=f"{table}_page")
+        df = df.iloc[(page - 1) * page_size:page * page_size]
+    with metrics.timed(section, 'render'):
+        st.dataframe(df)
+
+
+def show_figure(figures, section, chart, *params, **kwargs):
+    # Render step of a section, a miss means the figure store had to build the figure
+    with metrics.timed(section, 'render', cache='hit'):
+        st.plotly_chart(figures.get(chart, *params), **kwargs)
+
+
+def show_debug_panel():
+    totals, events = metrics.snapshot()
+    with st.sidebar.expander("Debug: timings and cache", expanded=True):
+        st.write("Totals for this server process")
+        st.dataframe([
+            {
+                'section': section,
+                'step': step,
+                'calls': values['calls'],
+                'mean (ms)': round(values['seconds'] * 1000 / values['calls'], 2),
+                'rows': values['rows'],
+                'hit rate': (
+                    f"{values['hits'] / (values['hits'] + values['misses']):.0%}"
+                    if values['hits'] + values['misses'] else ''
+                ),
+            }
+            for (section, step), values in sorted(totals.items())
+        ])
+        st.write("Latest events")
+        st.dataframe([
+            {**event, 'seconds': round(event['seconds'], 4)} for event in reversed(events[-20:])
+        ])
 
-df_summary['Enseignements de spécialité'] = df_summary['Enseignements de spécialité'].str.replace(' Spécialité', '', regex=False)
 
 st.sidebar.title("Navigation")
 page = st.sidebar.radio("Go to", ["Portfolio", "Parcoursup Project"])
@@ -38,7 +105,7 @@ if page == "Portfolio":
         st.write("I am looking for opportunities as a Data Analyst or Machine Learning Engineer, focusing on predictive modeling and natural language processing.")
         
     with me_col2:
-        st.image("IMG_7461.jpg", width=200)  # Adjust the path and size as needed
+        show_image("IMG_7461.jpg", 200)  # Adjust the path and size as needed
 
     # Skills and Tools Section
     st.header("🛠️ Skills and Tools")
@@ -132,7 +199,13 @@ if page == "Portfolio":
     st.markdown("© 2024 Thaïs Bordessoul. All rights reserved.")
 
 if page == "Parcoursup Project":
-    
+    # Only this page needs the dataset
+    version = parcoursup_data.dataset_version(parcoursup_data.database_paths())
+    with metrics.timed('load_data', 'compute', cache='hit'):
+        aggregates = load_data(version)
+    with metrics.timed('load_figures', 'compute', cache='hit'):
+        figures = load_figures(version)
+
     st.title("Parcoursup Admissions from 2021 to 2023")
     
     st.write("""
@@ -150,19 +223,7 @@ if page == "Parcoursup Project":
     # Chapter 1: Trends Over Time
     st.header("Part 1: Trends Over Time")
 
-    yearly_totals = df_summary.groupby('Année du Baccalauréat').agg({
-        'Nombre de candidats bacheliers ayant confirmé au moins un vœu': 'sum',
-        'Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission': 'sum',
-        'Nombre de candidats bacheliers ayant accepté une proposition d\'admission': 'sum'
-    }).reset_index()
-
-    fig_line = px.line(yearly_totals, x='Année du Baccalauréat', 
-                    y=['Nombre de candidats bacheliers ayant confirmé au moins un vœu',
-                        'Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission',
-                        'Nombre de candidats bacheliers ayant accepté une proposition d\'admission'],
-                    title="Trends in Candidates, Offers, and Acceptances",
-                    labels={'value': 'Number of Candidates', 'variable': 'Category'})
-    st.plotly_chart(fig_line, use_container_width=True)
+    show_figure(figures, 'part1_trends', 'yearly_trends', use_container_width=True)
 
     st.write("""
         This line chart shows how the numbers of candidates making wishes, receiving offers, and accepting admissions 
@@ -171,60 +232,35 @@ if page == "Parcoursup Project":
 
 
 
-    years = sorted(df_summary['Année du Baccalauréat'].unique())
+    years = aggregates['years']
 
     # Chapter 2: The Landscape of Choices
     st.header("Part 2: The Landscape of Choices")
 
-    year_for_sunburst = st.radio("Select a year:", years, key="sunburst_year")
-    df_year = df_summary[df_summary['Année du Baccalauréat'] == year_for_sunburst]
+    # Each widget-driven chart is a fragment: changing its radio reruns only that chart
+    @st.fragment
+    def subject_sunburst():
+        year_for_sunburst = st.radio("Select a year:", years, key="sunburst_year")
+        show_figure(figures, 'part2_sunburst', 'subject_sunburst', year_for_sunburst, use_container_width=True)
 
+        st.write(f"""
+            This sunburst chart shows the accurate distribution of subject combinations chosen by students in {year_for_sunburst}. 
+            Each segment represents the number of candidates who selected that particular combination of subjects.
+        """)
 
-    def split_subjects(subject):
-        return subject.split(',')
+    subject_sunburst()
 
-    df_year['Subject1'] = df_year['Enseignements de spécialité'].apply(lambda x: split_subjects(x)[0])
-    df_year['Subject2'] = df_year['Enseignements de spécialité'].apply(lambda x: split_subjects(x)[1] if len(split_subjects(x)) > 1 else 'Single')
+    @st.fragment
+    def top_specialties():
+        year_for_bar_chart = st.radio("Select a year:", years, key="bar_chart_year")
+        show_figure(figures, 'part2_specialties', 'top_specialties', year_for_bar_chart, use_container_width=True)
 
-    min_candidates_threshold = 1000 
+        st.write(f"""
+            This bar chart shows the top 10 most chosen specialties based on the number of confirmed wishes made by students in {year_for_bar_chart}.
+            Each bar represents a specialty and the total number of candidates who selected it.
+        """)
 
-    df_filtered = df_year[df_year['Nombre de candidats bacheliers ayant confirmé au moins un vœu'] >= min_candidates_threshold]
-
-    fig_sunburst = px.sunburst(df_filtered, path=['Subject1', 'Subject2'], 
-                                values='Nombre de candidats bacheliers ayant confirmé au moins un vœu',
-                                title=f"Subject Combinations in {year_for_sunburst}")
-    fig_sunburst.update_layout(height=1000)  # Adjust the value as needed
-    st.plotly_chart(fig_sunburst, use_container_width=True)
-
-    st.write(f"""
-        This sunburst chart shows the accurate distribution of subject combinations chosen by students in {year_for_sunburst}. 
-        Each segment represents the number of candidates who selected that particular combination of subjects.
-    """)
-
-    year_for_bar_chart = st.radio("Select a year:", years, key="bar_chart_year")
-    df_year_bar = df_summary[df_summary['Année du Baccalauréat'] == year_for_bar_chart]
-
-    df_year_bar['Specialties'] = df_year_bar['Enseignements de spécialité'].apply(lambda x: split_subjects(x))
-    df_exploded = df_year_bar.explode('Specialties')
-
-    df_grouped = df_exploded.groupby('Specialties').agg({'Nombre de candidats bacheliers ayant confirmé au moins un vœu': 'sum'}).reset_index()
-
-    df_filtered_grouped = df_grouped[df_grouped['Nombre de candidats bacheliers ayant confirmé au moins un vœu'] >= min_candidates_threshold]
-
-    top_10_specialties = df_filtered_grouped.nlargest(10, 'Nombre de candidats bacheliers ayant confirmé au moins un vœu')
-    fig_bar_chart = px.bar(top_10_specialties, 
-                        x='Specialties', 
-                        y='Nombre de candidats bacheliers ayant confirmé au moins un vœu',
-                        labels={'Specialties': 'Specialty', 'Nombre de candidats bacheliers ayant confirmé au moins un vœu': 'Number of Wishes'},
-                        title=f"Top 10 Most Chosen Specialties in {year_for_bar_chart}")
-
-    fig_bar_chart.update_layout(height=600, width=1000, title_x=0.5)  # Adjust layout as needed
-    st.plotly_chart(fig_bar_chart, use_container_width=True)
-
-    st.write(f"""
-        This bar chart shows the top 10 most chosen specialties based on the number of confirmed wishes made by students in {year_for_bar_chart}.
-        Each bar represents a specialty and the total number of candidates who selected it.
-    """)
+    top_specialties()
 
 
 
@@ -233,42 +269,19 @@ if page == "Parcoursup Project":
     st.header("Part 3: From Aspirations to Admissions")
 
     
-    year_for_tops = st.radio("Select a year:", years, key="tops_years")
-    df_year_tops = df_summary[df_summary['Année du Baccalauréat'] == year_for_tops]
-    df_year_tops['Subject1'] = df_year_tops['Enseignements de spécialité'].apply(lambda x: split_subjects(x)[0])
-    df_year_tops['Subject2'] = df_year_tops['Enseignements de spécialité'].apply(lambda x: split_subjects(x)[1] if len(split_subjects(x)) > 1 else 'Single')
-
-    df_duos = df_year_tops.groupby(['Subject1', 'Subject2'])['Nombre de candidats bacheliers ayant confirmé au moins un vœu'].sum().reset_index()
-
-    df_duos_sorted = df_duos.sort_values(by='Nombre de candidats bacheliers ayant confirmé au moins un vœu', ascending=False)
-
-    top_10_duos = df_duos_sorted.head(10)
-    st.write("Top 10 Most Popular Subject Combinations:")
-    st.dataframe(top_10_duos)
-    top_specialties_per_year = set()
-    years = df_summary['Année du Baccalauréat'].unique()
+    @st.fragment
+    def top_duos():
+        year_for_tops = st.radio("Select a year:", years, key="tops_years")
+        with metrics.timed('part3_duos', 'compute'):
+            top_10_duos = parcoursup_data.top_duos(aggregates, year_for_tops)
+            parcoursup_metrics.set_rows(len(aggregates['summary_by_year'][year_for_tops]))
+        with metrics.timed('part3_duos', 'render'):
+            st.write("Top 10 Most Popular Subject Combinations:")
+            st.dataframe(top_10_duos)
 
-    for year in years:
-        df_year = df_summary[df_summary['Année du Baccalauréat'] == year]
-        top_10_for_year = df_year.groupby('Enseignements de spécialité')['Nombre de candidats bacheliers ayant confirmé au moins un vœu'].sum().nlargest(10).index
-        top_specialties_per_year.update(top_10_for_year)
+    top_duos()
 
-    df_filtered = df_summary[df_summary['Enseignements de spécialité'].isin(top_specialties_per_year)]
-
-    df_pivot = df_filtered.pivot(index='Année du Baccalauréat', columns='Enseignements de spécialité', values='Nombre de candidats bacheliers ayant confirmé au moins un vœu')
-    fig = go.Figure()
-
-    for column in df_pivot.columns:
-        fig.add_trace(go.Scatter(x=df_pivot.index, y=df_pivot[column], mode='lines', name=column, line=dict(width=2)))
-
-    fig.update_layout(
-        title="Nombre de candidats bacheliers ayant confirmé au moins un vœu pour les spécialités les plus représentées",
-        xaxis_title="Année du Baccalauréat",
-        yaxis_title="Nombre de candidats",
-        template="plotly_dark",
-        legend_title="Enseignements de spécialité"
-    )
-    st.plotly_chart(fig)
+    show_figure(figures, 'part3_trends', 'specialty_trends')
 
 
     st.write("""
@@ -279,74 +292,19 @@ if page == "Parcoursup Project":
     # Chapter 4: Popular Formations
     st.header("Part 4: Popular Formations")
 
-    top_formations_wishes = df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant confirmé au moins un vœu'].sum().nlargest(10)
-    top_formations_proposals = df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission'].sum().nlargest(10)
-    top_formations_accepted = df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant accepté une proposition d\'admission'].sum().nlargest(10)
-
-    top_formations = pd.Index(top_formations_wishes.index).union(top_formations_proposals.index).union(top_formations_accepted.index)
-
-    df_evolution = pd.DataFrame({
-        'Formation': top_formations,
-        'Confirmed Wishes': df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant confirmé au moins un vœu'].sum().reindex(top_formations).values,
-        'Admission Proposals': df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission'].sum().reindex(top_formations).values,
-        'Accepted Admissions': df_detailed.groupby('Formation')['Nombre de candidats bacheliers ayant accepté une proposition d\'admission'].sum().reindex(top_formations).values
-    })
-
-    df_melted = df_evolution.melt(id_vars='Formation', value_vars=['Confirmed Wishes', 'Admission Proposals', 'Accepted Admissions'], 
-                                var_name='Stage', value_name='Count')
-
-    fig_bar_animation = px.bar(df_melted, 
-                            x='Formation', 
-                            y='Count', 
-                            color='Formation',
-                            animation_frame='Stage',
-                            title="Top 15 Formations by Confirmed Wishes, Admission Proposals, and Accepted Admissions",
-                            labels={'Count': 'Number of Students', 'Formation': 'Formation'},
-                            range_y=[0, df_melted['Count'].max()])
-
-    fig_bar_animation.update_layout(transition_duration=1000)
-    st.plotly_chart(fig_bar_animation, use_container_width=True)
-
-
-
+    formation_totals = aggregates['formation_totals']
 
-    categories = ["Nombre de candidats bacheliers ayant confirmé au moins un vœu","Nombre de candidats bacheliers ayant reçu au moins une proposition d\'admission","Nombre de candidats bacheliers ayant accepté une proposition d\'admission" ]
+    show_figure(figures, 'part4_stages', 'formation_stages', use_container_width=True)
 
-    top_formations_per_categorie = set()
 
-    for categorie in categories:
-        top_10_for_year = df_detailed.groupby('Formation')[categorie].sum().nlargest(15).index
-        top_formations_per_categorie.update(top_10_for_year)
 
-    columns_to_drop = ['Année du Baccalauréat', 'Enseignements de spécialité']
-    df_filtered = df_detailed[df_detailed['Formation'].isin(top_formations_per_categorie)]
-    df_filtered = df_filtered.drop(columns=columns_to_drop, axis=1)
 
-    df_grouped = df_filtered.groupby('Formation').sum().reset_index()
-    st.dataframe(df_grouped)
-    plot_data = df_grouped.set_index('Formation')[categories]
+    with metrics.timed('part4_categories', 'compute'):
+        df_grouped = formation_totals.loc[parcoursup_data.top_formations(aggregates, 15)].reset_index()
+        parcoursup_metrics.set_rows(len(formation_totals))
+    show_table('part4_categories', 'formation_table', df_grouped)
 
-    fig = go.Figure()
-
-    for formation in plot_data.index:
-        fig.add_trace(go.Scatter(
-            x=categories,
-            y=plot_data.loc[formation],
-            mode='lines+markers',
-            name=formation,
-            line=dict(width=2)
-        ))
-
-    fig.update_layout(
-        title="Nombre de candidats bacheliers par catégorie",
-        xaxis_title="Catégories",
-        yaxis_title="Nombre de candidats",
-        template="plotly_dark",
-        legend_title="Formations",
-        height=1000
-    )
-
-    st.plotly_chart(fig)
+    show_figure(figures, 'part4_categories', 'formation_categories')
 
     st.write("""
         We can remark that LAS (medecine cursus) was created in 2020, explaining the amount of wishes made in 2021 has it has replaced a very important previous formation, PACES.
@@ -354,77 +312,32 @@ if page == "Parcoursup Project":
         This gives us insight into which programs are most popular among students who have been admitted.
     """)
 
-    df_grouped = df_detailed.groupby('Formation').agg({
-        categories[0]: 'sum',
-        categories[1]: 'sum',
-        categories[2]: 'sum'
-    }).reset_index()
-
-    df_grouped['Pourcentage propositions reçues'] = df_grouped[categories[1]]* 100 / df_grouped[categories[0]]
-    df_grouped['Pourcentage propositions acceptées'] = df_grouped[categories[2]]* 100 / df_grouped[categories[0]]
-    st.write(categories[0])
-
-    df_selected = df_grouped
-    df_grouped = df_grouped.drop(columns=[categories[0], categories[1], categories[2]])
-    st.dataframe(df_grouped)
-
-    formation_choice = st.selectbox("Select a Formation:", df_selected['Formation'].unique())
-
-    df_selected = df_selected[df_selected['Formation'] == formation_choice]
-
-    labels = ['Wishes', 'Proposals Received', 'Proposals Accepted']
-    parents = ['', 'Wishes', 'Proposals Received']
-    values = [
-        df_selected[categories[0]].values[0], 
-        df_selected[categories[1]].values[0], 
-        df_selected[categories[2]].values[0]
-    ]
-
-    color_discrete_map = {
-        'Wishes': '#2ca02c',
-        'Proposals Received': '#2ca02c',
-        'Student Admitted': '#2ca02c',
-        'Proposal never received': '#8B0000', 
-        'Refused Admissions': '#8B0000'
-    }
-
-    refused_prop = df_selected[categories[0]].values[0]-df_selected[categories[1]].values[0]
-    refused_adm = df_selected[categories[1]].values[0]-df_selected[categories[2]].values[0]
-
-    fig = go.Figure(go.Sunburst(
-        labels=['Wishes', 'Proposals Received', 'Student Admitted', 'Proposal never received', 'Refused Admissions'],
-        parents=['', 'Wishes', 'Proposals Received', 'Wishes', 'Proposals Received'],
-        values=[df_selected[categories[0]].values[0], 
-                df_selected[categories[1]].values[0], 
-                df_selected[categories[2]].values[0],
-                refused_prop,
-                refused_adm,
-                refused_prop],
-        textinfo='label+value',
-        branchvalues='total',
-        marker=dict(colors=[
-            color_discrete_map['Wishes'],
-            color_discrete_map['Proposals Received'],
-            color_discrete_map['Student Admitted'],
-            color_discrete_map['Proposal never received'],
-            color_discrete_map['Refused Admissions']
-        ])
-    ))
+    funnel = aggregates['funnel']
 
-    
-    fig.update_layout(
-        title_text="Pourcentage of proposition received and accepted over the number of wishes made.",
-        height=600, 
-        paper_bgcolor="rgba(0,0,0,0)",
-        plot_bgcolor="rgba(0,0,0,0)" 
-    )
-    st.plotly_chart(fig, use_container_width=True)
+    st.write(WISHES)
+    df_grouped = funnel[[PROPOSALS_PERCENT, ACCEPTED_PERCENT]].reset_index()
+    show_table('part4_percentages', 'funnel_table', df_grouped)
+
+    # Only the funnel reruns when another formation is selected
+    @st.fragment
+    def formation_funnel():
+        formation_choice = st.selectbox("Select a Formation:", funnel.index)
 
-    st.write(
-        f"In {formation_choice}, out of {values[0]} wishes (100%), "
-        f"{values[1]} ({df_selected['Pourcentage propositions reçues'].values[0]:.2f}%) proposals were received, "
-        f"and {values[2]} ({df_selected['Pourcentage propositions acceptées'].values[0]:.2f}%) proposals were accepted."
-    )
+        # Indexed by formation, so these are lookups rather than a scan
+        with metrics.timed('part4_funnel', 'compute'):
+            values = [funnel.at[formation_choice, column] for column in COUNTS]
+            percentages = [funnel.at[formation_choice, column] for column in [PROPOSALS_PERCENT, ACCEPTED_PERCENT]]
+            parcoursup_metrics.set_rows(1)
+
+        show_figure(figures, 'part4_funnel', 'formation_funnel', formation_choice, use_container_width=True)
+
+        st.write(
+            f"In {formation_choice}, out of {values[0]} wishes (100%), "
+            f"{values[1]} ({percentages[0]:.2f}%) proposals were received, "
+            f"and {values[2]} ({percentages[1]:.2f}%) proposals were accepted."
+        )
+
+    formation_funnel()
 
 
     
@@ -436,3 +349,10 @@ st.sidebar.markdown("---")
 st.sidebar.info("Created by Thaïs Bordessoul")
 st.sidebar.info("Student in M1 DAI at EFREI PARIS")
 
+# Open the app with ?debug=1 to see where the time goes
+if st.query_params.get("debug") == "1":
+    show_debug_panel()
+
+# Picks up the last steps of this run unless the file was written less than a second ago
+metrics.flush_if_due()
+